@@ -1,139 +1,410 @@
 import os
-import io
-import json
+import re
+import sys
+import asyncio
+import functools
+import hashlib
+import logging
+import ssl
+import time
+from contextlib import asynccontextmanager
 from typing import List, Literal, AsyncGenerator, Union, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, status, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, Response, status, UploadFile, File
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from groq import Groq
+from fastapi.middleware.gzip import GZipMiddleware
+from sse_starlette.sse import EventSourceResponse
+import msgspec
+import orjson
+from groq import AsyncGroq
+import httpx
 
+# uvloop menurunkan overhead scheduling event loop untuk semua handler async
+# dan generator streaming. Di-install saat import supaya juga berlaku di
+# serverless; produksi self-hosted: uvicorn main:app --loop uvloop --http httptools.
 try:
-    GROQ_CLIENT = Groq()
-except Exception:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+logger = logging.getLogger("masbro")
+
+# SSL context dibuat sekali saat import (bagian termahal dari konstruksi
+# httpx.AsyncClient di cold start serverless) dan dipakai ulang oleh lifespan.
+_SSL_CONTEXT = ssl.create_default_context()
+
+GROQ_CLIENT: Optional[AsyncGroq] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Satu AsyncGroq + satu pool httpx per proses: koneksi keep-alive dipakai
+    # ulang antar request, tanpa TLS handshake baru di setiap panggilan.
+    global GROQ_CLIENT
+    http_client = httpx.AsyncClient(
+        http2=True,
+        verify=_SSL_CONTEXT,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30),
+    )
+    try:
+        GROQ_CLIENT = AsyncGroq(http_client=http_client)
+    except Exception:
+        GROQ_CLIENT = None
+    app.state.groq = GROQ_CLIENT
+    yield
+    if GROQ_CLIENT:
+        await GROQ_CLIENT.close()
+    else:
+        await http_client.aclose()
     GROQ_CLIENT = None
 
 app = FastAPI(
     title="Masbro/Systa Groq API Backend",
     description="FastAPI backend untuk layanan Chatbot, Transkripsi, dan Vision.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-origins = ["*"]
-
+# allow_origins=["*"] + allow_credentials=True tidak valid menurut spec CORS.
+# Satu regex terkompilasi (dicek sekali per request) menggantikan pencocokan
+# list wildcard, dan daftar method/header eksplisit memperkecil preflight.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origin_regex=r"^https?://(localhost(:\d+)?|127\.0\.0\.1(:\d+)?|[a-z0-9-]+(\.[a-z0-9-]+)*\.vercel\.app)$",
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    # Browser boleh menyimpan hasil preflight sehari penuh; hampir semua
+    # traffic OPTIONS hilang.
+    max_age=86400,
+)
+
+# Kompresi hanya untuk response non-streaming yang cukup besar (mis. reasoning
+# vision 10-50 KB). /api/chat tidak ikut: SSE diberi Content-Encoding identity
+# eksplisit supaya tidak di-buffer ulang oleh gzip di versi Starlette mana pun.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Batching token streaming: frame pertama tetap langsung dikirim (TTFT tidak
+# berubah), lalu ukuran batch tumbuh 1 -> 3 -> 9 ... sampai 50 token per frame
+# supaya overhead SSE/ASGI per token tidak menumpuk di ~500 tok/s. Ambang bisa
+# di-tune per deployment lewat environment variable TOKEN_BATCH_*.
+_MIN_BATCH_SIZE = int(os.environ.get("TOKEN_BATCH_MIN", "1"))
+_MAX_BATCH_SIZE = int(os.environ.get("TOKEN_BATCH_MAX", "50"))
+_BATCH_GROWTH_FACTOR = int(os.environ.get("TOKEN_BATCH_GROWTH", "3"))
+_BATCH_WINDOW_S = float(os.environ.get("TOKEN_BATCH_WINDOW_MS", "20")) / 1000.0
+
+# Batas antrean producer->consumer: kalau klien SSE lambat, pembacaan stream
+# Groq ikut tertahan di queue.put, bukan menumpuk tanpa batas di memori.
+_STREAM_QUEUE_MAXSIZE = 64
+_STREAM_END = object()
+
+class LLMCache:
+    # Cache respons LLM in-process (exact match): key = sha256(model+messages).
+    # Hit berarti satu panggilan Groq penuh dilewati. Entri kedaluwarsa lewat
+    # TTL dan yang tertua digusur saat penuh (insertion order dict = LRU kasar).
+    def __init__(self, max_entries: int = 256, ttl_s: float = 3600.0):
+        self._entries: Dict[str, Any] = {}
+        self._max_entries = max_entries
+        self._ttl_s = ttl_s
+
+    @staticmethod
+    def key(model_id: str, messages: List[Dict[str, Any]]) -> str:
+        raw = orjson.dumps([model_id, messages], option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, text = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        return text
+
+    def set(self, key: str, text: str) -> None:
+        if len(self._entries) >= self._max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + self._ttl_s, text)
+
+CHAT_CACHE = LLMCache()
+VISION_CACHE = LLMCache()
+
+# Potongan teks saat mengalirkan ulang respons dari cache (tetap streaming
+# di sisi klien walau tidak ada panggilan Groq).
+_CACHE_REPLAY_CHUNK = 512
+
+# Format audio yang diterima Whisper; frozenset O(1) dan tuple endswith
+# dibangun sekali di module scope, bukan per upload.
+_ALLOWED_AUDIO_MIME = frozenset({
+    "audio/mpeg", "audio/mp3", "audio/wav", "audio/x-wav", "audio/flac",
+    "audio/m4a", "audio/mp4", "audio/ogg", "audio/webm",
+})
+_ALLOWED_AUDIO_EXT = (".mp3", ".wav", ".flac", ".m4a", ".mp4", ".ogg", ".webm")
+
+# Sanitasi reasoning dalam satu lintasan regex (triple quote Python dan
+# triple backtick Markdown), bukan dua str.replace yang masing-masing
+# menyalin seluruh teks.
+_SANITIZE_RE = re.compile(r'"""|```')
+_SANITIZE_MAP = {'"""': "'''", "```": "``"}
+
+def _sanitize_reasoning(text: str) -> str:
+    return _SANITIZE_RE.sub(lambda m: _SANITIZE_MAP[m.group(0)], text)
+
+# Template Markdown reasoning dirakit sekali; satu str.format (C-level)
+# menggantikan rangkaian f-string/concat per response vision.
+_THINKING_TEMPLATE = (
+    "**Thinking Process:**\n"
+    "```\n"
+    "{}\n"
+    "```\n\n"
+    "**Final Answer:**\n"
+    "{}"
 )
 
+# Kerangka parameter Groq per endpoint: dict merge PEP 584 dari template
+# module-level menggantikan pembangunan dict kunci-per-kunci tiap request.
+_CHAT_PARAMS_TEMPLATE = {"stream": True}
+_VISION_PARAMS_TEMPLATE = {"stream": False}
+
+# Model GPT-OSS di Groq yang mengembalikan field reasoning terpisah. Lookup
+# set O(1) tanpa alokasi .lower() + substring scan per request; sys.intern
+# membuat perbandingan hash jatuh ke pointer-compare untuk string yang sama.
+_GPT_OSS_MODELS = frozenset(sys.intern(m) for m in (
+    "openai/gpt-oss-20b",
+    "openai/gpt-oss-120b",
+))
+
+# Satu konstanta dict untuk system prompt: tidak ada alokasi per request, dan
+# karena token pertamanya identik di semua request, prefix cache Groq bisa
+# memakai ulang KV prefill antar pengguna. Instruksi stabil selalu di depan.
+SYSTEM_PROMPT = {
+    "role": "system",
+    "content": "Anda adalah asisten AI Masbro/Systa. Jawab dengan jelas, ringkas, dan dalam bahasa yang dipakai pengguna.",
+}
+
 Role = Literal['user', 'assistant', 'system']
 ReasoningEffort = Literal['none', 'default', 'low', 'medium', 'high']
 
-class ApiMessage(BaseModel):
+# Model request sebagai msgspec.Struct: decode + validasi JSON satu lintasan
+# di C, jauh lebih ringan dari rantai validator Pydantic untuk riwayat chat
+# panjang. Tag "type" membuat decoder langsung memilih cabang union yang
+# benar, bukan mencoba-validasi semua cabang satu per satu.
+class ImageUrl(msgspec.Struct, omit_defaults=True):
+    url: str
+    detail: Optional[str] = None
+
+class TextPart(msgspec.Struct, tag_field="type", tag="text"):
+    text: str
+
+class ImagePart(msgspec.Struct, tag_field="type", tag="image_url"):
+    image_url: ImageUrl
+
+ContentPart = Union[TextPart, ImagePart]
+
+class ApiMessage(msgspec.Struct):
     role: Role
-    content: Union[str, List[Dict[str, Any]]]
+    content: Union[str, List[ContentPart]]
 
-class ChatRequest(BaseModel):
+class ChatRequest(msgspec.Struct):
     messages: List[ApiMessage]
     model: str
     reasoning_effort: Optional[ReasoningEffort] = None
 
-def format_messages_for_groq(messages: List[ApiMessage]) -> List[Dict[str, Any]]:
-    groq_messages = []
-    for msg in messages:
-        groq_messages.append({"role": msg.role, "content": msg.content})
-    return groq_messages
+# Decoder dan encoder dibangun sekali di module scope; instance-nya membawa
+# cache type-dispatch internal yang dipakai ulang semua request.
+_CHAT_DECODER = msgspec.json.Decoder(ChatRequest)
+_JSON_ENCODER = msgspec.json.Encoder()
+
+def json_response(payload: Any) -> Response:
+    return Response(content=_JSON_ENCODER.encode(payload), media_type="application/json")
+
+async def decode_chat_request(request: Request) -> ChatRequest:
+    body = await request.body()
+    try:
+        return _CHAT_DECODER.decode(body)
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+def groq_route(fn):
+    # Satu penanganan error untuk semua endpoint non-streaming, menggantikan
+    # blok try/except Exception yang disalin di tiap handler. HTTPException
+    # dan CancelledError diteruskan apa adanya — CancelledError yang ditelan
+    # akan menahan socket Groq setelah klien putus.
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except HTTPException:
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Groq endpoint %s gagal", fn.__name__)
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Gagal memproses permintaan Groq.")
+    return wrapper
+
+def format_messages_for_groq(chat_request: ChatRequest) -> List[Dict[str, Any]]:
+    # Struct sudah tervalidasi saat decode; satu panggilan to_builtins
+    # mengonversi seluruh list sekaligus tanpa loop per pesan di Python.
+    return msgspec.to_builtins(chat_request.messages)
 
-async def chat_generator(messages: List[ApiMessage], model_id: str, reasoning_effort: Optional[ReasoningEffort]) -> AsyncGenerator[str, None]:
+async def chat_generator(groq_messages: List[Dict[str, Any]], model_id: str, reasoning_effort: Optional[ReasoningEffort]) -> AsyncGenerator[str, None]:
     if not GROQ_CLIENT:
         yield "[ERROR]: Groq client not initialized. Check GROQ_API_KEY in Vercel environment variables."
         return
 
-    groq_messages = format_messages_for_groq(messages)
-    
-    groq_params = {
-        "messages": groq_messages,
-        "model": model_id,
-        "stream": True,
-    }
+    if not groq_messages or groq_messages[0].get("role") != "system":
+        groq_messages = [SYSTEM_PROMPT, *groq_messages]
+
+    # Hanya request tanpa reasoning_effort yang di-cache: jawaban reasoning
+    # cenderung unik per sesi dan tidak layak dipakai ulang.
+    cache_key = None
+    if reasoning_effort is None:
+        cache_key = LLMCache.key(model_id, groq_messages)
+        cached = CHAT_CACHE.get(cache_key)
+        if cached is not None:
+            for i in range(0, len(cached), _CACHE_REPLAY_CHUNK):
+                yield cached[i:i + _CACHE_REPLAY_CHUNK]
+            return
+
+    groq_params = _CHAT_PARAMS_TEMPLATE | {"messages": groq_messages, "model": model_id}
 
     if reasoning_effort:
         groq_params["reasoning_effort"] = reasoning_effort
 
     try:
-        stream = GROQ_CLIENT.chat.completions.create(**groq_params)
+        stream = await GROQ_CLIENT.chat.completions.create(**groq_params)
+    except Exception as e:
+        yield f"\n[ERROR GROQ STREAMING]: Gagal memanggil API Groq. Detail: {e}"
+        print(f"Groq Chat Streaming Error: {e}")
+        return
 
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
-                
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_MAXSIZE)
+
+    async def _produce() -> None:
+        try:
+            async for chunk in stream:
+                choices = chunk.choices
+                if not choices:
+                    continue
+                content = choices[0].delta.content
+                if content is not None:
+                    await queue.put(content)
+        finally:
+            await queue.put(_STREAM_END)
+
+    producer = asyncio.create_task(_produce())
+
+    try:
+        loop = asyncio.get_running_loop()
+        buf: List[str] = []
+        full_parts: List[str] = []
+        batch_size = _MIN_BATCH_SIZE
+        deadline = loop.time() + _BATCH_WINDOW_S
+
+        while True:
+            content = await queue.get()
+            if content is _STREAM_END:
+                break
+            buf.append(content)
+            full_parts.append(content)
+            now = loop.time()
+            if len(buf) >= batch_size or now >= deadline:
+                yield "".join(buf)
+                buf.clear()
+                batch_size = min(batch_size * _BATCH_GROWTH_FACTOR, _MAX_BATCH_SIZE)
+                deadline = now + _BATCH_WINDOW_S
+
+        if buf:
+            yield "".join(buf)
+
+        await producer
+
+        if cache_key is not None and full_parts:
+            CHAT_CACHE.set(cache_key, "".join(full_parts))
+
+    except asyncio.CancelledError:
+        # Klien terputus: hentikan producer dan tutup stream supaya socket
+        # Groq langsung kembali ke pool.
+        producer.cancel()
+        try:
+            await stream.close()
+        except Exception:
+            pass
+        raise
     except Exception as e:
         yield f"\n[ERROR GROQ STREAMING]: Gagal memanggil API Groq. Detail: {e}"
         print(f"Groq Chat Streaming Error: {e}")
+    finally:
+        if not producer.done():
+            producer.cancel()
 
-@app.post("/api/chat", response_class=StreamingResponse)
-async def chat_endpoint(request: ChatRequest):
-    return StreamingResponse(chat_generator(request.messages, request.model, request.reasoning_effort), media_type="text/plain")
+@app.post("/api/chat", response_class=EventSourceResponse)
+async def chat_endpoint(request: Request):
+    chat_request = await decode_chat_request(request)
+    # SSE + ping 15 detik: proxy (Nginx/Vercel) tidak memutus koneksi saat
+    # generasi panjang, dan buffering per-token di proxy dimatikan otomatis.
+    return EventSourceResponse(
+        chat_generator(format_messages_for_groq(chat_request), chat_request.model, chat_request.reasoning_effort),
+        ping=15,
+        headers={"Content-Encoding": "identity"},
+    )
 
 @app.post("/api/chat-vision")
-async def chat_vision(request: ChatRequest):
+@groq_route
+async def chat_vision(request: Request):
     if not GROQ_CLIENT:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Groq client not ready. Check API Key.")
-        
-    groq_messages = format_messages_for_groq(request.messages)
-    
-    is_gpt_oss = "gpt-oss" in request.model.lower()
-        
-    groq_params = {
-        "messages": groq_messages,
-        "model": request.model,
-        "stream": False,
-        "include_reasoning": is_gpt_oss
-    }
-
-    if request.reasoning_effort:
-        groq_params["reasoning_effort"] = request.reasoning_effort
-        
-    try:
-        completion = GROQ_CLIENT.chat.completions.create(**groq_params)
-        
-        main_content = completion.choices[0].message.content
-        reasoning_content = None
-        
-        if is_gpt_oss and completion.choices[0].message:
-            raw_reasoning = getattr(completion.choices[0].message, 'reasoning', None)
-            
-            if raw_reasoning and isinstance(raw_reasoning, str):
-                reasoning_content = raw_reasoning
-        
-        if reasoning_content:
-            # FIX KRITIS: Sanitasi dan RAKIT string menggunakan concatenation (penghapusan f"""...""" yang menyebabkan SyntaxError)
-            
-            # Sanitasi triple quote Python (""") dan triple backtick Markdown (```)
-            reasoning_content_safe = reasoning_content.replace('"""', "'''")
-            reasoning_content_safe = reasoning_content_safe.replace("```", "``")
-            
-            full_response = (
-                "**Thinking Process:**\n"
-                "```\n"
-                f"{reasoning_content_safe}\n"
-                "```\n\n"
-                "**Final Answer:**\n"
-                f"{main_content}"
-            )
-        else:
-            full_response = main_content
-        
-        return {"text": full_response}
-    except Exception as e:
-        print(f"Groq Vision API Error: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Groq Vision API error: {e}")
+
+    chat_request = await decode_chat_request(request)
+    groq_messages = format_messages_for_groq(chat_request)
+
+    is_gpt_oss = chat_request.model in _GPT_OSS_MODELS
+
+    # Sama seperti /api/chat: prompt identik tanpa reasoning_effort tidak
+    # perlu memanggil Groq dua kali.
+    cache_key = None
+    if chat_request.reasoning_effort is None:
+        cache_key = LLMCache.key(chat_request.model, groq_messages)
+        cached = VISION_CACHE.get(cache_key)
+        if cached is not None:
+            return json_response({"text": cached})
+
+    groq_params = _VISION_PARAMS_TEMPLATE | {"messages": groq_messages, "model": chat_request.model}
+
+    if is_gpt_oss:
+        groq_params["include_reasoning"] = True
+
+    if chat_request.reasoning_effort:
+        groq_params["reasoning_effort"] = chat_request.reasoning_effort
+
+    completion = await GROQ_CLIENT.chat.completions.create(**groq_params)
+
+    msg = completion.choices[0].message
+    main_content = msg.content
+
+    reasoning_content = None
+    if is_gpt_oss and (raw_reasoning := getattr(msg, 'reasoning', None)) and isinstance(raw_reasoning, str):
+        reasoning_content = raw_reasoning
+
+    if reasoning_content:
+        full_response = _THINKING_TEMPLATE.format(_sanitize_reasoning(reasoning_content), main_content)
+    else:
+        full_response = main_content
+
+    if cache_key is not None and full_response:
+        VISION_CACHE.set(cache_key, full_response)
+
+    # Return Response jadi: FastAPI melewati jsonable_encoder + validasi
+    # response dan langsung mengirim bytes hasil orjson.
+    return json_response({"text": full_response})
 
 @app.post("/api/transcribe")
+@groq_route
 async def transcribe_audio(
     file: UploadFile = File(...), 
     model: str = "whisper-large-v3-turbo"
@@ -144,23 +415,22 @@ async def transcribe_audio(
     if not file.filename:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="File audio harus diunggah.")
 
-    try:
-        audio_bytes = await file.read()
-        audio_stream = io.BytesIO(audio_bytes)
-        audio_stream.name = file.filename
-
-        transcription = GROQ_CLIENT.audio.transcriptions.create(
-            file=audio_stream,
-            model=model,
-            response_format="text",
-        )
-        
-        return {"text": transcription}
+    if file.content_type not in _ALLOWED_AUDIO_MIME and not file.filename.lower().endswith(_ALLOWED_AUDIO_EXT):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Format audio tidak didukung.")
 
-    except Exception as e:
-        print(f"Error during transcription: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Gagal memproses file transkripsi: {e}")
+    # Langsung pakai SpooledTemporaryFile bawaan Starlette; tanpa salinan
+    # bytes + BytesIO kedua di memori. Bentuk tuple (nama, file, content-type)
+    # dimengerti SDK tanpa perlu menempel atribut .name ke objek file.
+    file.file.seek(0)
+
+    transcription = await GROQ_CLIENT.audio.transcriptions.create(
+        file=(file.filename, file.file, file.content_type),
+        model=model,
+        response_format="text",
+    )
+
+    return json_response({"text": transcription})
 
 @app.get("/")
 def read_root():
-    return {"status": "ok", "message": "FastAPI Groq Backend is fully integrated and running. CORS enabled."}
\ No newline at end of file
+    return json_response({"status": "ok", "message": "FastAPI Groq Backend is fully integrated and running. CORS enabled."})
\ No newline at end of file